@@ -210,7 +210,9 @@ class ResNetFace(nn.Module):
         x = self.layer4(x)
         x = self.bn4(x)
         x = self.dropout(x)
-        x = x.view(x.size(0), -1)
+        # reshape instead of view, as x may be in channels_last format,
+        # where C, H, W cannot be merged without a copy.
+        x = x.reshape(x.size(0), -1)
         x = self.fc5(x)
         x = self.bn5(x)
 
@@ -4,8 +4,10 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 os.environ["TF_USE_LEGACY_KERAS"] = '1'
 
 import torch
+from torch.utils.data import DataLoader, Subset
 import re
 import glob
+import math
 import numpy as np
 from PIL import Image
 import cv2
@@ -59,6 +61,34 @@ def expand_paths(paths, filter_pat="_mask.png", num_samples=-1):
         all_paths = all_paths[-num_samples:]
     return all_paths
 
+# Stack example["image"] (HWC numpy arrays) of a batch into a [B, C, H, W] tensor,
+# and keep example["image_unnorm"] as a list of numpy arrays.
+# Defined at module level, so that it can be pickled to the DataLoader workers.
+def collate_images_chw(examples):
+    images = np.stack([ example["image"] for example in examples ], axis=0)
+    np_images = [ example["image_unnorm"] for example in examples ]
+    return torch.from_numpy(images).permute(0, 3, 1, 2), np_images
+
+# Load the images of dataset at indices with multiple workers. Each image is decoded only once.
+# Returns the normalized images as a [N, C, H, W] tensor, and the unnormalized images
+# as a list of numpy arrays in [0, 255].
+# Small batches, so that images are decoded by all workers in parallel.
+def load_images(dataset, indices, batch_size=4, num_workers=8):
+    # No more workers than batches, as the extra workers would be forked without loading any image.
+    # Typical subject folders only have 1~3 batches. With a single batch, load in the main process.
+    num_batches = math.ceil(len(indices) / batch_size)
+    num_workers = min(num_workers, os.cpu_count() or 1, num_batches)
+    if num_batches <= 1:
+        num_workers = 0
+    loader = DataLoader(Subset(dataset, list(indices)), batch_size=batch_size, shuffle=False,
+                        num_workers=num_workers, pin_memory=torch.cuda.is_available(),
+                        collate_fn=collate_images_chw)
+    images, np_images = [], []
+    for batch_images, batch_np_images in loader:
+        images.append(batch_images)
+        np_images.extend(batch_np_images)
+    return torch.cat(images, dim=0), np_images
+
 # gt_dir: the reference image folder, or the path of a single reference image.
 # num_samples: only evaluate the last (latest) num_samples images. 
 # If -1, then evaluate all images
@@ -75,10 +105,14 @@ def compare_folders(clip_evator, dino_evator, gt_dir, samples_dir, prompt, num_s
     sample_start_idx = 0 if num_samples == -1 else sample_data_loader.num_images - num_samples
     sample_range     = range(sample_start_idx, sample_data_loader.num_images)
 
-    gt_images = [torch.from_numpy(gt_data_loader[i]["image"]).permute(2, 0, 1) for i in range(gt_data_loader.num_images)]
-    gt_images = torch.stack(gt_images, axis=0)
-    sample_images = [torch.from_numpy(sample_data_loader[i]["image"]).permute(2, 0, 1) for i in sample_range]
-    sample_images = torch.stack(sample_images, axis=0)
+    # "image_unnorm": unnormalized numpy array image in [0, 255]
+    gt_images, gt_np_images = load_images(gt_data_loader, range(gt_data_loader.num_images))
+    if gt_self_compare:
+        # The samples are the gt images. Reuse them instead of reading the same files again.
+        sample_images    = gt_images[sample_start_idx:]
+        sample_np_images = gt_np_images[sample_start_idx:]
+    else:
+        sample_images, sample_np_images = load_images(sample_data_loader, sample_range)
     print(f"Class prompt: {prompt}")
     #sample_image_paths = [sample_data_loader[i]["image_path"] for i in sample_range]
     #print("Sampel paths:", sample_image_paths)
@@ -87,10 +121,6 @@ def compare_folders(clip_evator, dino_evator, gt_dir, samples_dir, prompt, num_s
         sim_img, sim_text = clip_evator.evaluate(sample_images, gt_images, prompt)
 
     # huggingface's ViT pipeline requires a list of PIL images or numpy images as input.
-    # "image_unnorm": unnormalized numpy array image in [0, 255]
-    gt_np_images     = [ gt_data_loader[i]["image_unnorm"]     for i in range(gt_data_loader.num_images) ]
-    sample_np_images = [ sample_data_loader[i]["image_unnorm"] for i in sample_range ]
-
     with torch.no_grad():
         sim_dino = dino_evator.image_pairwise_similarity(gt_np_images, sample_np_images)
 
@@ -392,8 +422,9 @@ def compare_face_folders(src_path, dst_path, src_num_samples=-1, dst_num_samples
 
 # extra_sig could be a regular expression
 def find_first_match(lst, search_term, extra_sig=""):
+    extra_sig_re = re.compile(extra_sig)
     for item in lst:
-        if search_term in item and re.search(extra_sig, item):
+        if search_term in item and extra_sig_re.search(item):
             return item
     return None  # If no match is found
 
@@ -404,18 +435,50 @@ def parse_range_str(range_str, fix_1_offset=False):
     if range_str is None:
         return None
     
-    result = []
     offset = 1 if fix_1_offset else 0
+    pieces = []
 
     for part in range_str.split(','):
         if '-' in part:
             a, b = part.split('-')
             a, b = int(a) - offset, int(b) - offset
-            result.extend(list(range(a, b + 1)))
         else:
-            a = int(part) - offset
-            result.append(a)
-    return result
+            a = b = int(part) - offset
+        pieces.append(np.arange(a, b + 1))
+    # Fill large ranges (e.g., "1-10000") in C, instead of one Python int at a time.
+    return np.concatenate(pieces).tolist()
+
+# Removed 'on top of a wooden floor', 'on top of a purple rug in a forest'
+# which will lead to weird layouts.
+# Removed 'red', 'purple', 'shiny', 'wet', 'cube shaped' which are not compatible with humans.
+# Added 'in iron man armor', 'in superman costume', 'playing guitar on a boat, ocean waves', 
+# 'jedi wielding a lightsaber, star wars' which are compatible with humans.
+_FACE_OR_ANIMAL_PROMPTS = (
+    'a {0}{1}{2} in the jungle',                                       # 0
+    'a {0}{1}{2} in the snow',
+    'a {0}{1}{2} on the beach',
+    'a {0}{1}{2} on a cobblestone street',
+    'a {0}{1}{2} on top of pink fabric',
+    'a {0}{1}{2} with a city in the background',                       # 5
+    'a {0}{1}{2} with a mountain in the background',
+    'a {0}{1}{2} with a blue house in the background',
+    'a {0}{1}{2} wearing a red hat',                                   
+    'a {0}{1}{2} wearing a santa hat',
+    'a {0}{1}{2} wearing a rainbow scarf',                             # 10
+    'a {0}{1}{2} wearing a black top hat and a monocle',
+    'a {0}{1}{2} in a chef outfit',
+    'a {0}{1}{2} in a firefighter outfit',                             
+    'a {0}{1}{2} in a police outfit',
+    'a {0}{1}{2} wearing pink glasses',                                # 15
+    'a {0}{1}{2} wearing a yellow shirt',
+    'a {0}{1}{2} in a purple wizard outfit',
+    'a {0}{1}{2} in iron man armor',
+    'a {0}{1}{2} in superman costume',
+    'a {0}{1}{2} playing guitar on a boat, ocean waves',               # 20
+    'a {0}{1}{2} jedi wielding a lightsaber, star wars',
+)
+# Built once at import, instead of on every call of format_prompt_list().
+_ALL_PROMPTS = _FACE_OR_ANIMAL_PROMPTS + tuple(community_prompt_list)
 
 # prompt_set_name: 'dreambench', 'community', 'all'.
 def format_prompt_list(subject_string, z_prefix, z_suffix, 
@@ -453,43 +516,13 @@ def format_prompt_list(subject_string, z_prefix, z_suffix,
     ]
     '''
     
-    # Removed 'on top of a wooden floor', 'on top of a purple rug in a forest'
-    # which will lead to weird layouts.
-    # Removed 'red', 'purple', 'shiny', 'wet', 'cube shaped' which are not compatible with humans.
-    # Added 'in iron man armor', 'in superman costume', 'playing guitar on a boat, ocean waves', 
-    # 'jedi wielding a lightsaber, star wars' which are compatible with humans.
-    face_or_animal_prompt_list = [
-    'a {0}{1}{2} in the jungle',                                       # 0
-    'a {0}{1}{2} in the snow',
-    'a {0}{1}{2} on the beach',
-    'a {0}{1}{2} on a cobblestone street',
-    'a {0}{1}{2} on top of pink fabric',
-    'a {0}{1}{2} with a city in the background',                       # 5
-    'a {0}{1}{2} with a mountain in the background',
-    'a {0}{1}{2} with a blue house in the background',
-    'a {0}{1}{2} wearing a red hat',                                   
-    'a {0}{1}{2} wearing a santa hat',
-    'a {0}{1}{2} wearing a rainbow scarf',                             # 10
-    'a {0}{1}{2} wearing a black top hat and a monocle',
-    'a {0}{1}{2} in a chef outfit',
-    'a {0}{1}{2} in a firefighter outfit',                             
-    'a {0}{1}{2} in a police outfit',
-    'a {0}{1}{2} wearing pink glasses',                                # 15
-    'a {0}{1}{2} wearing a yellow shirt',
-    'a {0}{1}{2} in a purple wizard outfit',
-    'a {0}{1}{2} in iron man armor',
-    'a {0}{1}{2} in superman costume',
-    'a {0}{1}{2} playing guitar on a boat, ocean waves',               # 20
-    'a {0}{1}{2} jedi wielding a lightsaber, star wars',
-    ]
-
     # humans/animals and cartoon characters.
     if prompt_set_name == 'community':
         orig_prompt_list = community_prompt_list
     elif prompt_set_name == 'dreambench':
-        orig_prompt_list = face_or_animal_prompt_list
+        orig_prompt_list = _FACE_OR_ANIMAL_PROMPTS
     elif prompt_set_name == 'all':
-        orig_prompt_list = face_or_animal_prompt_list + community_prompt_list
+        orig_prompt_list = _ALL_PROMPTS
     else:
         breakpoint()
 
@@ -30,6 +30,11 @@ class GMA(nn.Module):
             self.config.dropout = 0
         if not hasattr(self.config, 'mixed_precision'):
             self.config.mixed_precision = True
+        # amp_dtype: torch.float16 or torch.bfloat16, the autocast dtype of the fnet/cnet/update-block
+        # activations. bfloat16 has the same exponent range as float32, so it's less prone to overflow.
+        # The correlation volume is always computed in float32, as fmap1/fmap2 are cast to float before CorrBlock.
+        if not hasattr(self.config, 'amp_dtype'):
+            self.config.amp_dtype = torch.float16
         if not hasattr(self.config, 'num_heads'):
             self.config.num_heads = 1
 
@@ -90,7 +95,7 @@ class GMA(nn.Module):
         cdim = self.context_dim
 
         # run the feature network
-        with torch.amp.autocast('cuda', enabled=self.config.mixed_precision):
+        with torch.amp.autocast('cuda', enabled=self.config.mixed_precision, dtype=self.config.amp_dtype):
             fmap1, fmap2 = self.fnet([image1, image2])
 
         # fmap1, fmap2: [1, 256, 55, 128]. 1/8 size of the original image.
@@ -100,7 +105,7 @@ class GMA(nn.Module):
             
         self.corr_fn = CorrBlock(fmap1, fmap2, radius=self.config.corr_radius)
 
-        with torch.amp.autocast('cuda', enabled=self.config.mixed_precision):
+        with torch.amp.autocast('cuda', enabled=self.config.mixed_precision, dtype=self.config.amp_dtype):
             # run the context network
             # cnet: context network to extract features from image1 only.
             # cnet arch is the same as fnet. 
@@ -136,7 +141,7 @@ class GMA(nn.Module):
             corr = self.corr_fn(coords1)  # index correlation volume
             flow = coords1 - coords0
             
-            with torch.amp.autocast('cuda', enabled=self.config.mixed_precision):
+            with torch.amp.autocast('cuda', enabled=self.config.mixed_precision, dtype=self.config.amp_dtype):
                 # net_feat: hidden features of SepConvGRU. 
                 # inp_feat: input  features to SepConvGRU.
                 # up_mask is scaled to 0.25 of original values.
@@ -149,6 +154,11 @@ class GMA(nn.Module):
             # F(t+1) = F(t) + \Delta(t)
             coords1 = coords1 + delta_flow
 
+            # In test_mode 1, only the upsampled flow of the last iteration is returned.
+            # So skip upsampling the intermediate predictions.
+            if test_mode == 1 and itr < num_iters - 1:
+                continue
+
             # upsample predictions
             if up_mask is None:
                 # coords0 is fixed as original coords.
@@ -211,7 +221,7 @@ class GMA(nn.Module):
         net_feat = torch.zeros(BS, hdim, H, W).to(fmap1.device)
         inp_feat = torch.zeros(BS, cdim, H, W).to(fmap1.device)
 
-        with torch.amp.autocast('cuda', enabled=self.config.mixed_precision):
+        with torch.amp.autocast('cuda', enabled=self.config.mixed_precision, dtype=self.config.amp_dtype):
             # attention is a uniform matrix, since inp_feat is all zeros.
             attention = self.att(inp_feat)
                 
@@ -236,7 +246,7 @@ class GMA(nn.Module):
             corr = self.corr_fn(coords1)  
             flow = coords1 - coords0
             
-            with torch.amp.autocast('cuda', enabled=self.config.mixed_precision):
+            with torch.amp.autocast('cuda', enabled=self.config.mixed_precision, dtype=self.config.amp_dtype):
                 # net_feat: hidden features of SepConvGRU. 
                 # inp_feat: input  features to SepConvGRU.
                 # up_mask is scaled to 0.25 of original values.
@@ -249,6 +259,11 @@ class GMA(nn.Module):
             # F(t+1) = F(t) + \Delta(t)
             coords1 = coords1 + delta_flow
 
+            # Only the upsampled flow of the last iteration is used.
+            # So skip upsampling the intermediate predictions.
+            if itr < num_iters - 1:
+                continue
+
             # upsample predictions
             if up_mask is None:
                 # coords0 is fixed as original coords.
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_linear_bn_eval
 import cv2
 import numpy as np
 from evaluation.arcface_resnet import resnet_face18
@@ -11,29 +12,79 @@ def load_image_for_arcface(img_path, device='cpu'):
     image = cv2.imread(img_path)
     if image is None:
         return None
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    image = image.transpose((2, 0, 1))
-    image = image[np.newaxis, :, :, :]    
-    image = image.astype(np.float32, copy=False)
+    cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+    image = np.ascontiguousarray(image.transpose((2, 0, 1))[np.newaxis])
+    # Transfer the uint8 image (1/4 the size of float32), and normalize on the target device.
+    image_ts = torch.from_numpy(image)
+    if torch.device(device).type == 'cuda':
+        image_ts = image_ts.pin_memory().to(device, non_blocking=True)
+    else:
+        image_ts = image_ts.to(device)
     # Normalize to [-1, 1].
-    image -= 127.5
-    image /= 127.5
-    image_ts = torch.from_numpy(image).to(device)
+    image_ts = image_ts.to(torch.float32).sub_(127.5).mul_(1 / 127.5)
     return image_ts
 
+# Fold the BatchNorm layers that directly follow a conv/linear layer into the weights of that layer,
+# and replace them with nn.Identity. model has to be in eval mode.
+# IRBlock.bn0 and ResNetFace.bn4 don't follow a conv, so they are kept.
+def fold_arcface_bn(model):
+    for m in list(model.modules()):
+        for conv_name, bn_name in [ ('conv1', 'bn1'), ('conv2', 'bn2') ]:
+            conv, bn = getattr(m, conv_name, None), getattr(m, bn_name, None)
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                setattr(m, conv_name, fuse_conv_bn_eval(conv, bn))
+                setattr(m, bn_name, nn.Identity())
+        # downsample: nn.Sequential(conv, bn).
+        if isinstance(m, nn.Sequential) and len(m) == 2 \
+          and isinstance(m[0], nn.Conv2d) and isinstance(m[1], nn.BatchNorm2d):
+            m[0] = fuse_conv_bn_eval(m[0], m[1])
+            m[1] = nn.Identity()
+
+    if isinstance(getattr(model, 'fc5', None), nn.Linear) and isinstance(getattr(model, 'bn5', None), nn.BatchNorm1d):
+        model.fc5 = fuse_linear_bn_eval(model.fc5, model.bn5)
+        model.bn5 = nn.Identity()
+    return model
+
+# Prepare the frozen arcface backbone for inference, in place.
+def prepare_arcface_for_inference(arcface, device, dtype):
+    arcface.eval()
+    # arcface is frozen, so BN layers can be folded once here. Folding is done in float32,
+    # before the folded weights are cast to dtype.
+    fold_arcface_bn(arcface)
+    # arcface is kept at float16 instead of being INT8-quantized: the aligned images are embedded with grad
+    # enabled, and quantized modules are not differentiable. Besides, torch.ao INT8 kernels only run on cpu.
+    arcface.to(device, dtype=dtype, memory_format=torch.channels_last)
+    # Input faces are always 128x128, but the batch size (number of fg + bg faces) changes every step.
+    # dynamic=None lets the compiler switch to a dynamic batch dim after the first recompile, instead of
+    # recompiling for every new batch size and falling back to eager once the recompile limit is hit.
+    # Only compile forward(), so that the state_dict keys of arcface are unchanged.
+    # NOTE: not mode="reduce-overhead", as CUDA graph replays overwrite the outputs of previous calls,
+    # while the ref embeddings are still in use when the aligned images are embedded.
+    # No warm-up here, as the wrapper is usually created on cpu and moved to GPU afterwards.
+    arcface.forward = torch.compile(arcface.forward, dynamic=None)
+    return arcface
+
+# A zero loss scalar with the same dtype and device as t.
+# Only created when needed, i.e., when no face is detected.
+def zero_loss_like(t):
+    return torch.zeros((), dtype=t.dtype, device=t.device)
+
 class ArcFaceWrapper(nn.Module):
     def __init__(self, device='cpu', dtype=torch.float16, ckpt_path='models/arcface-resnet18_110.pth'):
         super(ArcFaceWrapper, self).__init__()
         self.arcface = resnet_face18(False)
         ckpt_state_dict = torch.load(ckpt_path, map_location='cpu')
-        for key in list(ckpt_state_dict.keys()):
-            new_key = key.replace("module.", "")
-            ckpt_state_dict[new_key] = ckpt_state_dict.pop(key)
+        # Strip the "module." prefix added by DataParallel.
+        ckpt_state_dict = { key.removeprefix("module."): value for key, value in ckpt_state_dict.items() }
 
         self.arcface.load_state_dict(ckpt_state_dict)
-        self.arcface.eval()
         self.dtype = dtype
-        self.arcface.to(device, dtype=self.dtype)
+        prepare_arcface_for_inference(self.arcface, device, self.dtype)
+        # Arcface takes grayscale images as input. RGB to grayscale is a 1x1 conv with these weights.
+        # Non-persistent, so that it's not saved into (or expected from) checkpoints.
+        self.register_buffer('rgb_to_gray_weights',
+                             torch.tensor([0.299, 0.587, 0.114], device=device).view(1, 3, 1, 1),
+                             persistent=False)
 
         self.retinaface = RetinaFaceClient(device=device)
         # We keep retinaface at float32, as it doesn't require grad and won't consume much memory.
@@ -47,7 +98,7 @@ class ArcFaceWrapper(nn.Module):
     # Suppose images_ts has been normalized to [-1, 1].
     # Cannot wrap this function with @torch.compile. Otherwise a lot of warnings will be spit out.
     def embed_image_tensor(self, images_ts, T=20, bleed=0, embed_bg_faces=True,
-                           use_whole_image_if_no_face=False, enable_grad=True):
+                           use_whole_image_if_no_face=False, enable_grad=True, inference_mode=False):
         # retina_crop_face() crops on the input tensor, so that computation graph w.r.t. 
         # the input tensor is preserved.
         # But the cropping operation is wrapped with torch.no_grad().
@@ -60,23 +111,38 @@ class ArcFaceWrapper(nn.Module):
         if fg_face_crops is None:
             return None, None, None, failed_inst_indices
         
-        # Arcface takes grayscale images as input
-        rgb_to_gray_weights = torch.tensor([0.299, 0.587, 0.114], device=images_ts.device).view(1, 3, 1, 1)
-        # Convert RGB to grayscale
-        fg_faces_gray = (fg_face_crops * rgb_to_gray_weights).sum(dim=1, keepdim=True)
+        rgb_to_gray_weights = self.rgb_to_gray_weights.to(fg_face_crops.dtype)
+        # Convert RGB to grayscale in one conv, without materializing the weighted RGB tensor.
+        fg_faces_gray = F.conv2d(fg_face_crops, rgb_to_gray_weights)
         # Resize to (128, 128); arcface takes 128x128 images as input.
-        fg_faces_gray = F.interpolate(fg_faces_gray, size=(128, 128), mode='bilinear', align_corners=False)
-        with torch.set_grad_enabled(enable_grad):
-            fg_faces_emb = self.arcface(fg_faces_gray.to(self.dtype))
+        # crop_faces() already outputs 128x128 crops, in which case resizing is a no-op and is skipped.
+        if fg_faces_gray.shape[-2:] != (128, 128):
+            fg_faces_gray = F.interpolate(fg_faces_gray, size=(128, 128), mode='bilinear', align_corners=False)
 
+        # inference_mode: skip autograd bookkeeping (version counters and view tracking) altogether.
+        # Only for embeddings that don't need grad, i.e., enable_grad is ignored.
         if embed_bg_faces and bg_face_crops_flat is not None:
-            bg_faces_gray = (bg_face_crops_flat * rgb_to_gray_weights).sum(dim=1, keepdim=True)
-            bg_faces_gray = F.interpolate(bg_faces_gray, size=(128, 128), mode='bilinear', align_corners=False)
-            with torch.set_grad_enabled(enable_grad):
-                bg_faces_emb = self.arcface(bg_faces_gray.to(self.dtype))
+            bg_faces_gray = F.conv2d(bg_face_crops_flat, rgb_to_gray_weights)
+            if bg_faces_gray.shape[-2:] != (128, 128):
+                bg_faces_gray = F.interpolate(bg_faces_gray, size=(128, 128), mode='bilinear', align_corners=False)
+            # Embed fg and bg faces in one forward pass. arcface is in eval mode,
+            # so the embeddings are the same as embedding them separately.
+            all_faces_gray = torch.cat([fg_faces_gray, bg_faces_gray], dim=0)
+            with torch.inference_mode() if inference_mode else torch.set_grad_enabled(enable_grad):
+                all_faces_emb = self.arcface(all_faces_gray.to(self.dtype, memory_format=torch.channels_last))
+            fg_faces_emb, bg_faces_emb = all_faces_emb.split([fg_faces_gray.shape[0], bg_faces_gray.shape[0]], dim=0)
         else:
+            with torch.inference_mode() if inference_mode else torch.set_grad_enabled(enable_grad):
+                fg_faces_emb = self.arcface(fg_faces_gray.to(self.dtype, memory_format=torch.channels_last))
             bg_faces_emb = None
 
+        if inference_mode:
+            # Inference tensors cannot be saved for backward, e.g., when they are compared with
+            # embeddings that require grad. Cloning them outside inference mode gives normal tensors.
+            fg_faces_emb = fg_faces_emb.clone()
+            if bg_faces_emb is not None:
+                bg_faces_emb = bg_faces_emb.clone()
+
         return fg_faces_emb, bg_faces_emb, fg_face_bboxes, failed_inst_indices
 
     # T: minimal face height/width to be detected.
@@ -84,11 +150,11 @@ class ArcFaceWrapper(nn.Module):
     # aligned_images: the generated   images.
     def calc_arcface_align_loss(self, ref_images, aligned_images, T=20, bleed=2, 
                                 suppress_bg_faces=True,
-                                use_whole_image_if_no_face=False):
+                                use_whole_image_if_no_face=False, verbose=False):
         # ref_fg_face_bboxes: long tensor of [BS, 4], where BS is the batch size.
         ref_fg_faces_emb, _, ref_fg_face_bboxes, ref_failed_inst_indices = \
             self.embed_image_tensor(ref_images, T, bleed, embed_bg_faces=False,
-                                    use_whole_image_if_no_face=False, enable_grad=False)
+                                    use_whole_image_if_no_face=False, enable_grad=False, inference_mode=True)
         # bg_embs are not separated by instances, but flattened. 
         # We don't align them, just suppress them. So we don't need the batch dimension.
         aligned_fg_faces_emb, aligned_bg_faces_emb, aligned_fg_face_bboxes, aligned_failed_inst_indices = \
@@ -96,13 +162,12 @@ class ArcFaceWrapper(nn.Module):
                                     use_whole_image_if_no_face=use_whole_image_if_no_face, 
                                     enable_grad=True)
         
-        zero_losses = [ torch.tensor(0., dtype=ref_images.dtype, device=ref_images.device) for _ in range(2) ]
         if len(ref_failed_inst_indices) > 0:
             print(f"Failed to detect faces in ref_images-{ref_failed_inst_indices}")
-            return zero_losses[0], zero_losses[1], None
+            return zero_loss_like(ref_images), zero_loss_like(ref_images), None
         if len(aligned_failed_inst_indices) > 0:
             print(f"Failed to detect faces in aligned_images-{aligned_failed_inst_indices}")
-            return zero_losses[0], zero_losses[1], None
+            return zero_loss_like(ref_images), zero_loss_like(ref_images), None
 
         # If the numbers of instances in ref_fg_faces_emb and aligned_fg_faces_emb are different, then there's only one ref image, 
         # and multiple aligned images of the same person.
@@ -110,18 +175,32 @@ class ArcFaceWrapper(nn.Module):
         if len(ref_fg_faces_emb) < len(aligned_fg_faces_emb):
             ref_fg_faces_emb = ref_fg_faces_emb.repeat(len(aligned_fg_faces_emb)//len(ref_fg_faces_emb), 1)
         
-        # labels = 1: align the embeddings of the same person.
-        loss_arcface_align = F.cosine_embedding_loss(ref_fg_faces_emb, aligned_fg_faces_emb, torch.ones(ref_fg_faces_emb.shape[0]).to(ref_fg_faces_emb.device))
-        print(f"loss_arcface_align: {loss_arcface_align.item():.2f}")
+        # Align the embeddings of the same person. Equivalent to F.cosine_embedding_loss() with labels = 1,
+        # but doesn't need to allocate the labels.
+        loss_arcface_align = (1 - F.cosine_similarity(ref_fg_faces_emb, aligned_fg_faces_emb, dim=-1)).mean()
+        # .item() forces a device sync. So only print the loss in verbose mode.
+        if verbose:
+            print(f"loss_arcface_align: {loss_arcface_align.item():.2f}")
 
         if suppress_bg_faces and aligned_bg_faces_emb is not None:
             # Suppress background faces by pushing their embeddings towards zero.
-            loss_bg_faces_suppress = (aligned_bg_faces_emb**2).mean()
-            print(f"loss_bg_faces_suppress: {loss_bg_faces_suppress.item():.2f}")
+            loss_bg_faces_suppress = aligned_bg_faces_emb.square().mean()
+            if verbose:
+                print(f"loss_bg_faces_suppress: {loss_bg_faces_suppress.item():.2f}")
         else:
             if suppress_bg_faces and aligned_bg_faces_emb is None:
                 print("loss_bg_faces_suppress = 0. No background faces detected in aligned_images. ")
 
-            loss_bg_faces_suppress = zero_losses[0]
+            loss_bg_faces_suppress = zero_loss_like(ref_images)
 
         return loss_arcface_align, loss_bg_faces_suppress, aligned_fg_face_bboxes
+
+# CPU smoke test of the arcface backbone as prepared for inference (folded BN, channels_last, compiled).
+# Random weights, so no checkpoint is needed. Run from the repo root: python -m ldm.modules.arcface_wrapper
+if __name__ == "__main__":
+    arcface = prepare_arcface_for_inference(resnet_face18(False), 'cpu', torch.float32)
+    with torch.no_grad():
+        faces_gray = torch.randn(2, 1, 128, 128).to(memory_format=torch.channels_last)
+        faces_emb  = arcface(faces_gray)
+    assert faces_emb.shape == (2, 512), faces_emb.shape
+    print(f"arcface smoke test passed: {tuple(faces_emb.shape)}")
@@ -266,9 +266,14 @@ def calc_stats(emb_name, embeddings, mean_dim=0, norm_dim=1):
     print(f"{emb_name}: L1 {l1_loss.item():.4f}, L2 {l2_loss.item():.4f}", end=", ")
     print(f"Norms: min: {norms.min():.4f}, max: {norms.max():.4f}, mean: {norms.mean():.4f}, std: {norms.std():.4f}")
 
+# A double-quoted string, or a sequence of non-space characters.
+_SPLIT_RE    = re.compile(r'"[^"]*"|\S+')
+# set -g subjects  alexachung    alita...
+# At least one character in the value (after the variable name).
+_SET_LINE_RE = re.compile(r"^set -g ([a-zA-Z_]+)\s+(\S.*)")
+
 def split_string(input_string):
-    pattern = r'"[^"]*"|\S+'
-    substrings = re.findall(pattern, input_string)
+    substrings = _SPLIT_RE.findall(input_string)
     substrings = [ s.strip('"') for s in substrings ]
     return substrings
 
@@ -281,22 +286,22 @@ def parse_subject_file(subject_file_path):
         lines = f.readlines()
         lines = [line.strip() for line in lines]
         for line in lines:
-            if re.search(r"^set -g [a-zA-Z_]+ ", line):
-                # set -g subjects  alexachung    alita...
-                # At least one character in the value (after the variable name).
-                mat = re.search(r"^set -g ([a-zA-Z_]+)\s+(\S.*)", line)
-                if mat is not None:
-                    var_name = mat.group(1)
-                    substrings = split_string(mat.group(2))
-                    values = substrings
-
-                    if len(values) == 1 and values[0].startswith("$"):
-                        # e.g., set -g cls_strings    $cls_delta_strings
-                        values = subj_info[values[0][1:]]
-
-                    subj_info[var_name] = values
-                else:
-                    breakpoint()
+            # Cheap prefix check, to skip blank lines, comments and other commands without running the regex.
+            if not line.startswith("set -g "):
+                continue
+            mat = _SET_LINE_RE.match(line)
+            if mat is None:
+                continue
+
+            var_name = mat.group(1)
+            substrings = split_string(mat.group(2))
+            values = substrings
+
+            if len(values) == 1 and values[0].startswith("$"):
+                # e.g., set -g cls_strings    $cls_delta_strings
+                values = subj_info[values[0][1:]]
+
+            subj_info[var_name] = values
 
     for var_name in [ "subjects", "subj_types", "data_folder" ]:
         if var_name not in subj_info: